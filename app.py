@@ -4,11 +4,16 @@
 import datetime
 import json
 import logging
+import random
 import sqlite3
 import threading
-from typing import Any, Dict, List
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
 
 import requests
+import zstandard
+from requests.adapters import HTTPAdapter
 from apscheduler.schedulers.background import BackgroundScheduler
 from flask import Flask, jsonify
 
@@ -27,23 +32,90 @@ POLL_INTERVAL_SECONDS = 60  # fetch events every minute
 MAX_REPOS = 5
 MAX_EVENTS = 500
 MAX_DAYS = 7
+RATE_LIMIT_BUFFER = MAX_REPOS  # stop polling when fewer requests than this remain
+PAYLOAD_COMPRESSION_LEVEL = 3  # zstd level for the stored raw event JSON
+MAX_ATTEMPTS = 6  # requests per repository per poll, retries included
+# Total retry sleep per repository per poll, kept below POLL_INTERVAL_SECONDS so that
+# a throttled repository cannot hold up the next scheduled poll
+MAX_BACKOFF_SECONDS = POLL_INTERVAL_SECONDS // 2
+MAX_ERROR_STREAK = 6  # a failing repository skips at most 2**MAX_ERROR_STREAK polls
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
 
+# Shared SQLite connection, opened once by init_db() and guarded by _DB_LOCK
+_CONN: Optional[sqlite3.Connection] = None
+_DB_LOCK = threading.Lock()
 
-def load_config() -> List[str]:
+# SQL statements are module constants so the connection's statement cache
+# keeps them prepared across calls
+INSERT_SQL = """INSERT OR IGNORE INTO events
+                    (id, repo, event_type, created_at, created_ts)
+                VALUES (?, ?, ?, ?, ?)"""
+INSERT_PAYLOAD_SQL = "INSERT OR IGNORE INTO event_payloads (id, raw_json) VALUES (?, ?)"
+SELECT_PAYLOAD_SQL = "SELECT raw_json FROM event_payloads WHERE id = ?"
+# The inner query picks the latest MAX_EVENTS events, the outer one restores ascending order
+SELECT_RECENT_SQL = """SELECT created_ts FROM (
+                           SELECT created_ts FROM events
+                           WHERE repo = ? AND event_type = ? AND created_ts >= ?
+                           ORDER BY created_ts DESC
+                           LIMIT ?)
+                       ORDER BY created_ts ASC"""
+# Average interval between consecutive events is (last - first) / (count - 1),
+# computed per repository and event type over at most the latest MAX_EVENTS
+# events. Pairs with fewer than 2 events have no interval and are skipped.
+STATS_SQL = """SELECT repo, event_type,
+                      (MAX(created_ts) - MIN(created_ts)) * 1.0 / (COUNT(*) - 1)
+               FROM (SELECT repo, event_type, created_ts,
+                            ROW_NUMBER() OVER (
+                                PARTITION BY repo, event_type ORDER BY created_ts DESC
+                            ) AS position
+                     FROM events WHERE created_ts >= ?)
+               WHERE position <= ?
+               GROUP BY repo, event_type
+               HAVING COUNT(*) >= 2"""
+
+# Last /stats result as a single (computed at, results) tuple under the "stats" key,
+# so readers get both values in one atomic lookup. Valid for POLL_INTERVAL_SECONDS,
+# and cleared whenever new events are stored.
+_STATS_CACHE: Dict[str, Tuple[float, Dict[str, Dict[str, float]]]] = {}
+
+# Shared HTTP session, keeps connections to the GitHub API alive between polls
+SESSION = requests.Session()
+SESSION.headers.update(
+    {
+        "Accept": "application/vnd.github.v3+json",
+        "User-Agent": "github-events-tracker",
+    }
+)
+SESSION.mount(
+    "https://", HTTPAdapter(pool_connections=MAX_REPOS, pool_maxsize=MAX_REPOS)
+)
+# Worker threads shared by every poll, one per repository
+POLL_EXECUTOR = ThreadPoolExecutor(max_workers=MAX_REPOS, thread_name_prefix="poll")
+
+# Last ETag seen per repository, sent back as If-None-Match to get cheap 304 responses
+ETAGS: Dict[str, str] = {}
+# Latest GitHub rate limit status, from the X-RateLimit-* response headers
+RATE_LIMIT: Dict[str, int] = {}
+# Consecutive failed polls per repository, and how many upcoming polls it sits out
+ERROR_STREAKS: Dict[str, int] = {}
+SKIPPED_POLLS: Dict[str, int] = {}
+
+
+def load_config() -> List[Tuple[str, str]]:
     """
     Load list of repositories from a JSON config file.
     The config file should contain a key "repositories" that maps to a list of repo full names.
     Example:
       { "repositories": ["owner1/repo1", "owner2/repo2"] }
+    Returns (repo, events API URL) pairs for up to MAX_REPOS repositories.
     """
     try:
         with open(CONFIG_FILE, "r", encoding="utf-8") as f:
             config = json.load(f)
-            repos = config.get("repositories", [])
-            if len(repos) > MAX_REPOS:
-                repos = repos[:MAX_REPOS]  # only monitor up to MAX_REPOS repositories
+            # only monitor up to MAX_REPOS repositories
+            repos = config.get("repositories", [])[:MAX_REPOS]
             logger.info("Configured repositories: %s", repos)
-            return repos
+            return [(repo, GITHUB_API_URL.format(repo=repo)) for repo in repos]
     except FileNotFoundError:
         logger.error("Config file not found: %s", CONFIG_FILE)
         return []
@@ -61,45 +133,150 @@ REPOSITORIES = load_config()
 
 def init_db() -> None:
     """
-    Initialize the SQLite database and create the events table if it does not exist.
+    Initialize the SQLite database and create the events and event_payloads tables
+    if they do not exist. Raw payloads live in their own table so that the queries
+    on events only read narrow rows.
+    The connection is kept open and shared by all database functions.
     """
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute(
+    global _CONN  # pylint: disable=global-statement
+    close_db()
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-64000")
+    conn.execute(
         """CREATE TABLE IF NOT EXISTS events (
                     id TEXT PRIMARY KEY,
                     repo TEXT,
                     event_type TEXT,
                     created_at TEXT,
-                    raw_json TEXT
+                    created_ts INTEGER
                 )"""
     )
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS event_payloads (
+                    id TEXT PRIMARY KEY,
+                    raw_json BLOB
+                ) WITHOUT ROWID"""
+    )
+    # Databases created before created_ts existed get the column added and backfilled,
+    # and databases created before event_payloads existed get their payloads moved there.
+    # One transaction, so an interrupted migration is redone on the next start.
+    conn.execute("BEGIN")
+    try:
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(events)")}
+        if "created_ts" not in columns:
+            conn.execute("ALTER TABLE events ADD COLUMN created_ts INTEGER")
+            conn.execute(
+                "UPDATE events SET created_ts = CAST(strftime('%s', created_at) AS INTEGER)"
+            )
+        if "raw_json" in columns:
+            conn.execute(
+                """INSERT OR IGNORE INTO event_payloads (id, raw_json)
+                       SELECT id, raw_json FROM events"""
+            )
+            conn.execute("ALTER TABLE events DROP COLUMN raw_json")
+    except sqlite3.Error:
+        conn.rollback()
+        raise
     conn.commit()
-    conn.close()
+    conn.execute("DROP INDEX IF EXISTS idx_repo_type_time")
+    conn.execute("DROP INDEX IF EXISTS idx_time")
+    conn.execute(
+        """CREATE INDEX IF NOT EXISTS idx_repo_type_ts
+               ON events (repo, event_type, created_ts)"""
+    )
+    # idx_repo_type_ts also covers the /stats query (a skip-scan that already yields
+    # rows in partition order), so a separate created_ts index is not needed
+    conn.execute("DROP INDEX IF EXISTS idx_ts")
+    conn.execute("ANALYZE")
+    conn.execute("PRAGMA optimize")
+    _CONN = conn
+    _STATS_CACHE.clear()
+
+
+def close_db() -> None:
+    """
+    Close the shared database connection, if one is open.
+    """
+    global _CONN  # pylint: disable=global-statement
+    with _DB_LOCK:
+        if _CONN is not None:
+            _CONN.close()
+            _CONN = None
+
+
+def parse_timestamp(created_at: Optional[str]) -> Optional[int]:
+    """
+    Convert a GitHub ISO 8601 UTC timestamp (e.g. "2025-01-31T12:00:00Z")
+    to UNIX seconds. Returns None if the timestamp is missing or invalid.
+    """
+    if not created_at:
+        return None
+    try:
+        return int(datetime.datetime.fromisoformat(created_at).timestamp())
+    except ValueError:
+        logger.error("Invalid event timestamp: %s", created_at)
+        return None
+
+
+def window_start() -> int:
+    """
+    Return the UNIX timestamp at which the MAX_DAYS rolling window starts.
+    """
+    return int(time.time()) - MAX_DAYS * 86400
 
 
-def insert_event(event: Dict[str, Any], repo: str) -> None:
+def insert_event(event: Dict[str, Any], repo: str) -> bool:
     """
     Insert a GitHub event into the database.
     The event is uniquely identified by its "id" field.
+    Returns True if the event was stored (or was already present).
+    """
+    return insert_events([event], repo)
+
+
+def insert_events(events: List[Dict[str, Any]], repo: str) -> bool:
+    """
+    Insert a batch of GitHub events for a repository into the database,
+    using a single transaction. Events already stored (same "id") are ignored.
+    Returns True if the transaction was committed, False if a database error was logged.
     """
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
     try:
-        c.execute(
-            """INSERT OR IGNORE INTO events (id, repo, event_type, created_at, raw_json)
-                     VALUES (?, ?, ?, ?, ?)""",
+        rows = [
             (
                 event.get("id"),
                 repo,
                 event.get("type"),
                 event.get("created_at"),
-                json.dumps(event),
-            ),
-        )
-        conn.commit()
+                parse_timestamp(event.get("created_at")),
+            )
+            for event in events
+        ]
+        payload_rows = [
+            (
+                event.get("id"),
+                zstandard.compress(
+                    json.dumps(event, separators=(",", ":")).encode("utf-8"),
+                    PAYLOAD_COMPRESSION_LEVEL,
+                ),
+            )
+            for event in events
+        ]
+        with _DB_LOCK:
+            _CONN.execute("BEGIN")
+            try:
+                _CONN.executemany(INSERT_SQL, rows)
+                _CONN.executemany(INSERT_PAYLOAD_SQL, payload_rows)
+            except sqlite3.Error:
+                _CONN.rollback()
+                raise
+            _CONN.commit()
+            _STATS_CACHE.clear()
+        return True
     except sqlite3.IntegrityError as e:
-        logger.error("Integrity error while inserting event %s: %s", event.get("id"), e)
+        logger.error("Integrity error while inserting events for %s: %s", repo, e)
     except sqlite3.OperationalError as e:
         logger.error(
             "Operational error: Possible database lock or missing table: %s", e
@@ -110,8 +287,23 @@ def insert_event(event: Dict[str, Any], repo: str) -> None:
         logger.error("Failed to serialize event JSON: %s", e)
     # except Exception as e:
     #     logger.error("Failed to insert event: %s", e)
-    finally:
-        conn.close()
+    return False
+
+
+def get_event_payload(event_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Return the raw GitHub event stored under the given id, or None if it is unknown.
+    Payloads are stored as zstd-compressed JSON; rows written as plain JSON text
+    by older versions are also supported.
+    """
+    with _DB_LOCK:
+        row = _CONN.execute(SELECT_PAYLOAD_SQL, (event_id,)).fetchone()
+    if row is None:
+        return None
+    raw_json = row[0]
+    if isinstance(raw_json, bytes):
+        raw_json = zstandard.decompress(raw_json)
+    return json.loads(raw_json)
 
 
 def get_recent_events(repo: str, event_type: str) -> List[Any]:
@@ -120,41 +312,149 @@ def get_recent_events(repo: str, event_type: str) -> List[Any]:
     that occurred within the last MAX_DAYS days.
     If more than MAX_EVENTS events are found,
     return only the most recent MAX_EVENTS (sorted ascending by created_at).
+    Event times are returned as timezone-aware UTC datetimes.
+    """
+    with _DB_LOCK:
+        rows = _CONN.execute(
+            SELECT_RECENT_SQL, (repo, event_type, window_start(), MAX_EVENTS)
+        ).fetchall()
+    return [datetime.datetime.fromtimestamp(row[0], datetime.UTC) for row in rows]
+
+
+def update_rate_limit(response: requests.Response) -> None:
+    """
+    Record the rate limit status reported by GitHub in the response headers.
+    """
+    try:
+        RATE_LIMIT["remaining"] = int(response.headers["X-RateLimit-Remaining"])
+        RATE_LIMIT["reset"] = int(response.headers["X-RateLimit-Reset"])
+    except (KeyError, ValueError):
+        pass
+
+
+def is_rate_limited() -> bool:
+    """
+    Return True if fewer than RATE_LIMIT_BUFFER requests remain before the rate limit resets.
+    """
+    if "remaining" not in RATE_LIMIT:
+        return False
+    return (
+        RATE_LIMIT["remaining"] < RATE_LIMIT_BUFFER
+        and time.time() < RATE_LIMIT["reset"]
+    )
+
+
+def is_retryable(response: requests.Response) -> bool:
+    """
+    Return True if the request should be retried: server errors, 429 Too Many Requests,
+    and 403 responses carrying a Retry-After header (GitHub secondary rate limits).
+    A 403 for an exhausted primary rate limit is not retried, since it only clears
+    at the reset time; is_rate_limited() pauses polling until then instead.
+    """
+    if response.status_code == 403:
+        return "Retry-After" in response.headers
+    return response.status_code in RETRY_STATUS_CODES
+
+
+def retry_delay(response: requests.Response, attempt: int) -> float:
+    """
+    Return how long to wait before retrying: the Retry-After value if GitHub sent one,
+    otherwise 2**attempt seconds, plus up to 1s of jitter.
+    """
+    try:
+        delay = int(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        delay = 2**attempt
+    return delay + random.random()
+
+
+def get_with_backoff(url: str, headers: Dict[str, str]) -> requests.Response:
+    """
+    GET the given URL with the shared session, retrying retryable responses
+    with exponential backoff, for up to MAX_ATTEMPTS requests in total.
+    Retrying stops once the total wait would exceed MAX_BACKOFF_SECONDS; the
+    failure is then recorded and the repository is retried on a later poll.
+    """
+    response = SESSION.get(url, headers=headers, timeout=15)
+    update_rate_limit(response)
+    waited = 0.0
+    for attempt in range(MAX_ATTEMPTS - 1):
+        if not is_retryable(response):
+            break
+        delay = retry_delay(response, attempt)
+        if waited + delay > MAX_BACKOFF_SECONDS:
+            logger.warning(
+                "GitHub returned %s for %s, giving up until a later poll",
+                response.status_code,
+                url,
+            )
+            break
+        waited += delay
+        logger.warning(
+            "GitHub returned %s for %s, retrying in %.1f seconds",
+            response.status_code,
+            url,
+            delay,
+        )
+        time.sleep(delay)
+        response = SESSION.get(url, headers=headers, timeout=15)
+        update_rate_limit(response)
+    return response
+
+
+def record_poll_result(repo: str, succeeded: bool) -> None:
     """
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    cutoff = (
-        datetime.datetime.now(datetime.UTC) - datetime.timedelta(days=MAX_DAYS)
-    ).isoformat() + "Z"
-    query = """SELECT created_at FROM events
-               WHERE repo = ? AND event_type = ? AND created_at >= ?
-               ORDER BY datetime(created_at) ASC"""
-    c.execute(query, (repo, event_type, cutoff))
-    rows = c.fetchall()
-    conn.close()
-    # Convert the created_at strings to datetime objects
-    events = [datetime.datetime.fromisoformat(row[0].replace("Z", "")) for row in rows]
-    # If more than MAX_EVENTS events, only take the latest MAX_EVENTS
-    if len(events) > MAX_EVENTS:
-        events = events[-MAX_EVENTS:]
-    return events
-
-
-def fetch_repo_events(repo: str) -> None:
+    Track consecutive failures per repository. After the n-th failure in a row,
+    the repository sits out the next 2**n polls (n capped at MAX_ERROR_STREAK).
+    """
+    if succeeded:
+        ERROR_STREAKS.pop(repo, None)
+        SKIPPED_POLLS.pop(repo, None)
+        return
+    streak = min(ERROR_STREAKS.get(repo, 0) + 1, MAX_ERROR_STREAK)
+    ERROR_STREAKS[repo] = streak
+    SKIPPED_POLLS[repo] = 2**streak
+    logger.warning("Skipping the next %d polls for %s", 2**streak, repo)
+
+
+def should_poll(repo: str) -> bool:
+    """
+    Return False if the repository is sitting out this poll after recent failures.
+    """
+    if SKIPPED_POLLS.get(repo, 0) > 0:
+        SKIPPED_POLLS[repo] -= 1
+        return False
+    return True
+
+
+def fetch_repo_events(repo: str, url: str) -> None:
     """
     Fetch the latest events for a given repository using the GitHub Events API.
     New events are inserted into the database.
-    To minimize requests, we rely on the API returning only recent events.
+    To minimize requests, we rely on the API returning only recent events,
+    and send the last ETag so that unchanged feeds return 304 Not Modified,
+    which does not count against the rate limit.
+    Throttled and failed requests are retried with backoff (see get_with_backoff),
+    and repositories that keep failing are polled less often (see record_poll_result).
     """
-    url = GITHUB_API_URL.format(repo=repo)
-    headers = {"Accept": "application/vnd.github.v3+json"}
+    headers = {}
+    if repo in ETAGS:
+        headers["If-None-Match"] = ETAGS[repo]
+    succeeded = False
     try:
-        response = requests.get(url, headers=headers, timeout=15)
-        if response.status_code == 200:
+        response = get_with_backoff(url, headers)
+        if response.status_code == 304:
+            logger.info("No new events for %s", repo)
+            succeeded = True
+        elif response.status_code == 200:
             events = response.json()
             logger.info("Fetched %d events for %s", len(events), repo)
-            for event in events:
-                insert_event(event, repo)
+            # Only advance the ETag once the events are stored, otherwise the
+            # next poll would get a 304 and the failed batch would be lost
+            if insert_events(events, repo):
+                if "ETag" in response.headers:
+                    ETAGS[repo] = response.headers["ETag"]
+                succeeded = True
         else:
             logger.error(
                 "Failed to fetch events for %s: %s", repo, response.status_code
@@ -171,24 +471,46 @@ def fetch_repo_events(repo: str) -> None:
         logger.error("Failed to decode JSON response for %s", repo)
     # except Exception as e:
     #     logger.error("Error fetching events for %s: %s", repo, e)
+    record_poll_result(repo, succeeded)
 
 
 def poll_github_events() -> None:
     """
     Poll GitHub events for all configured repositories.
     This function is intended to be scheduled to run periodically.
+    Repositories are fetched concurrently on the shared POLL_EXECUTOR workers.
+    The poll is skipped while the GitHub rate limit is nearly exhausted.
     """
+    if is_rate_limited():
+        logger.warning(
+            "GitHub rate limit nearly exhausted (%d left), skipping poll until %s",
+            RATE_LIMIT["remaining"],
+            datetime.datetime.fromtimestamp(RATE_LIMIT["reset"], datetime.UTC),
+        )
+        return
     logger.info("Polling GitHub events...")
-    for repo in REPOSITORIES:
-        fetch_repo_events(repo)
+    futures = [
+        POLL_EXECUTOR.submit(fetch_repo_events, repo, url)
+        for repo, url in REPOSITORIES
+        if should_poll(repo)
+    ]
+    # result() re-raises unexpected worker exceptions so the scheduler logs them
+    for future in futures:
+        future.result()
 
 
 def start_scheduler() -> None:
     """
     Start background scheduler for polling GitHub events.
+    The first poll runs immediately, then every POLL_INTERVAL_SECONDS.
     """
     scheduler = BackgroundScheduler()
-    scheduler.add_job(poll_github_events, "interval", seconds=POLL_INTERVAL_SECONDS)
+    scheduler.add_job(
+        poll_github_events,
+        "interval",
+        seconds=POLL_INTERVAL_SECONDS,
+        next_run_time=datetime.datetime.now(),
+    )
     scheduler.start()
     logger.info("Started background scheduler for GitHub polling.")
 
@@ -212,41 +534,25 @@ def get_stats():
           "repo2": { ... }
       }
     """
+    now = time.time()
+    cached = _STATS_CACHE.get("stats")
+    if cached is not None and now - cached[0] < POLL_INTERVAL_SECONDS:
+        return jsonify(cached[1])
+
     results: Dict[str, Dict[str, float]] = {}
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    # Get distinct repository and event type combinations from events in the last MAX_DAYS days
-    cutoff = (
-        datetime.datetime.now(datetime.UTC) - datetime.timedelta(days=MAX_DAYS)
-    ).isoformat() + "Z"
-    c.execute(
-        """SELECT DISTINCT repo, event_type FROM events WHERE created_at >= ?""",
-        (cutoff,),
-    )
-    pairs = c.fetchall()
-    conn.close()
-
-    for repo, event_type in pairs:
-        event_times = get_recent_events(repo, event_type)
-        if len(event_times) < 2:
-            # Not enough events to compute an interval
-            continue
-        # Compute average time difference (in seconds) between consecutive events
-        total_diff = (event_times[-1] - event_times[0]).total_seconds()
-        avg_interval = total_diff / (len(event_times) - 1)
-        if repo not in results:
-            results[repo] = {}
-        results[repo][event_type] = avg_interval
+    with _DB_LOCK:
+        rows = _CONN.execute(STATS_SQL, (window_start(), MAX_EVENTS)).fetchall()
+        for repo, event_type, avg_interval in rows:
+            results.setdefault(repo, {})[event_type] = avg_interval
+        # Cached under the lock so a concurrent insert cannot be overwritten by stale results
+        _STATS_CACHE["stats"] = (now, results)
 
     return jsonify(results)
 
 
 if __name__ == "__main__":
     init_db()
-    # Start background thread for polling
-    poll_thread = threading.Thread(target=poll_github_events)
-    poll_thread.start()
-    # Also start the APScheduler
+    # Start the APScheduler, which also runs the initial poll
     start_scheduler()
     # Run the Flask app
     app.run(host="127.0.0.1", port=5000)
@@ -7,8 +7,11 @@ This module contains both unit tests and integration tests for the main applicat
 import datetime
 import json
 import os
+import sqlite3
 import tempfile
+import time
 import unittest
+from unittest import mock
 
 import app  # our main application module
 
@@ -41,7 +44,13 @@ class TestLoadConfig(unittest.TestCase):
             app.CONFIG_FILE = self.config_path
             repos = app.load_config()
             self.assertEqual(len(repos), app.MAX_REPOS)
-            expected_repos = [f"owner/repo{num}" for num in range(1, app.MAX_REPOS + 1)]
+            expected_repos = [
+                (
+                    f"owner/repo{num}",
+                    f"https://api.github.com/repos/owner/repo{num}/events",
+                )
+                for num in range(1, app.MAX_REPOS + 1)
+            ]
             self.assertEqual(repos, expected_repos)
         finally:
             app.CONFIG_FILE = original_config_file
@@ -65,6 +74,7 @@ class TestDatabaseFunctions(unittest.TestCase):
 
     def tearDown(self):
         """Restore the original DB_FILE value and remove the temporary database file."""
+        app.close_db()
         app.DB_FILE = self.original_db_file
         os.unlink(self.temp_db.name)
 
@@ -89,6 +99,236 @@ class TestDatabaseFunctions(unittest.TestCase):
         self.assertEqual(len(events), 2)
         self.assertLess(events[0], events[1])
 
+    def test_insert_events_batch_ignores_duplicates(self):
+        """Test that a batch insert stores each event id only once."""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        events = [
+            {
+                "id": str(num % 2),
+                "type": "TestEvent",
+                "created_at": (now - datetime.timedelta(minutes=num))
+                .isoformat()
+                .replace("+00:00", "Z"),
+            }
+            for num in range(4)
+        ]
+        app.insert_events(events, "owner/repo")
+        app.insert_events(events, "owner/repo")
+        events = app.get_recent_events("owner/repo", "TestEvent")
+        self.assertEqual(len(events), 2)
+
+    def test_init_db_migrates_baseline_schema(self):
+        """Test that init_db upgrades a database created with the original events schema."""
+        app.close_db()
+        conn = sqlite3.connect(self.temp_db.name)
+        # Replace the schema created in setUp with the original one
+        conn.execute("DROP TABLE events")
+        conn.execute("DROP TABLE event_payloads")
+        conn.execute(
+            """CREATE TABLE events (
+                        id TEXT PRIMARY KEY,
+                        repo TEXT,
+                        event_type TEXT,
+                        created_at TEXT,
+                        raw_json TEXT
+                    )"""
+        )
+        created_at = (
+            (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=1))
+            .replace(microsecond=0)
+            .isoformat()
+            .replace("+00:00", "Z")
+        )
+        event = {"id": "1", "type": "TestEvent", "created_at": created_at}
+        conn.execute(
+            "INSERT INTO events VALUES (?, ?, ?, ?, ?)",
+            ("1", "owner/repo", "TestEvent", created_at, json.dumps(event)),
+        )
+        conn.commit()
+        conn.close()
+
+        app.init_db()
+        events = app.get_recent_events("owner/repo", "TestEvent")
+        self.assertEqual(events, [datetime.datetime.fromisoformat(created_at)])
+        self.assertEqual(app.get_event_payload("1"), event)
+
+    def test_event_payload_is_compressed_and_restored(self):
+        """Test that the raw event is stored compressed and read back unchanged."""
+        event = {
+            "id": "1",
+            "type": "TestEvent",
+            "created_at": "2025-01-31T12:00:00Z",
+            "payload": {"commits": [{"message": "fix"}] * 20},
+        }
+        app.insert_event(event, "owner/repo")
+        self.assertEqual(app.get_event_payload("1"), event)
+        self.assertIsNone(app.get_event_payload("missing"))
+
+    def test_get_recent_events_limits_to_max_events(self):
+        """Test that only the latest MAX_EVENTS events are returned, in ascending order."""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        events = [
+            {
+                "id": str(num),
+                "type": "TestEvent",
+                "created_at": (now - datetime.timedelta(minutes=num))
+                .isoformat()
+                .replace("+00:00", "Z"),
+            }
+            for num in range(5)
+        ]
+        app.insert_events(events, "owner/repo")
+        original_max_events = app.MAX_EVENTS
+        try:
+            app.MAX_EVENTS = 3
+            recent = app.get_recent_events("owner/repo", "TestEvent")
+        finally:
+            app.MAX_EVENTS = original_max_events
+        self.assertEqual(len(recent), 3)
+        self.assertEqual(recent, sorted(recent))
+        latest = now.replace(microsecond=0)
+        self.assertEqual(recent[-1], latest)
+
+
+class TestFetchRepoEvents(unittest.TestCase):
+    """Tests for fetch_repo_events and the GitHub polling helpers,
+    with the HTTP session mocked out."""
+
+    def setUp(self):
+        """Create a temporary SQLite database and reset the polling state."""
+        self.temp_db = (
+            tempfile.NamedTemporaryFile(  # pylint: disable=consider-using-with
+                delete=False
+            )
+        )
+        self.temp_db.close()
+        self.original_db_file = app.DB_FILE
+        app.DB_FILE = self.temp_db.name
+        app.init_db()
+        app.ETAGS.clear()
+        app.RATE_LIMIT.clear()
+        app.ERROR_STREAKS.clear()
+        app.SKIPPED_POLLS.clear()
+
+    def tearDown(self):
+        """Restore the original DB_FILE value and remove the temporary database file."""
+        app.close_db()
+        app.DB_FILE = self.original_db_file
+        os.unlink(self.temp_db.name)
+        app.ETAGS.clear()
+        app.RATE_LIMIT.clear()
+        app.ERROR_STREAKS.clear()
+        app.SKIPPED_POLLS.clear()
+
+    @staticmethod
+    def make_response(status_code, body=None, headers=None):
+        """Build a mock requests.Response."""
+        response = mock.Mock(status_code=status_code, headers=headers or {})
+        response.json.return_value = body
+        return response
+
+    def test_etag_is_sent_and_not_modified_is_skipped(self):
+        """Test that the stored ETag is sent back and a 304 response inserts nothing."""
+        event = {
+            "id": "1",
+            "type": "PushEvent",
+            "created_at": datetime.datetime.now(datetime.timezone.utc)
+            .isoformat()
+            .replace("+00:00", "Z"),
+        }
+        responses = [
+            self.make_response(200, [event], {"ETag": '"abc"'}),
+            self.make_response(304),
+        ]
+        with mock.patch.object(app.SESSION, "get", side_effect=responses) as get:
+            app.fetch_repo_events("owner/repo", "https://example.com/events")
+            app.fetch_repo_events("owner/repo", "https://example.com/events")
+        self.assertEqual(app.ETAGS["owner/repo"], '"abc"')
+        self.assertEqual(get.call_args_list[0].kwargs["headers"], {})
+        self.assertEqual(
+            get.call_args_list[1].kwargs["headers"], {"If-None-Match": '"abc"'}
+        )
+        self.assertEqual(len(app.get_recent_events("owner/repo", "PushEvent")), 1)
+
+    def test_etag_is_kept_when_insert_fails(self):
+        """Test that a failed insert does not advance the ETag or count as a success."""
+        app.ETAGS["owner/repo"] = '"old"'
+        response = self.make_response(200, [], {"ETag": '"new"'})
+        with mock.patch.object(app.SESSION, "get", return_value=response):
+            with mock.patch.object(app, "insert_events", return_value=False):
+                app.fetch_repo_events("owner/repo", "https://example.com/events")
+        self.assertEqual(app.ETAGS["owner/repo"], '"old"')
+        self.assertEqual(app.ERROR_STREAKS["owner/repo"], 1)
+
+    def test_poll_is_skipped_when_rate_limited(self):
+        """Test that no request is made while the rate limit is nearly exhausted."""
+        app.RATE_LIMIT.update({"remaining": 0, "reset": int(time.time()) + 60})
+        with mock.patch.object(app.SESSION, "get") as get:
+            app.poll_github_events()
+        get.assert_not_called()
+
+    def test_throttled_request_is_retried_with_backoff(self):
+        """Test that a 503 and a 429 with Retry-After are retried before succeeding."""
+        responses = [
+            self.make_response(503),
+            self.make_response(429, headers={"Retry-After": "5"}),
+            self.make_response(200, []),
+        ]
+        with mock.patch.object(
+            app.SESSION, "get", side_effect=responses
+        ) as get, mock.patch.object(app.time, "sleep") as sleep:
+            app.fetch_repo_events("owner/repo", "https://example.com/events")
+        self.assertEqual(get.call_count, 3)
+        delays = [call.args[0] for call in sleep.call_args_list]
+        self.assertTrue(1 <= delays[0] < 2)
+        self.assertTrue(5 <= delays[1] < 6)
+        self.assertNotIn("owner/repo", app.ERROR_STREAKS)
+
+    def test_backoff_stops_at_total_wait_budget(self):
+        """Test that retries stop once the total wait would exceed MAX_BACKOFF_SECONDS."""
+        response = self.make_response(
+            429, headers={"Retry-After": str(app.MAX_BACKOFF_SECONDS * 2 // 3)}
+        )
+        with mock.patch.object(
+            app.SESSION, "get", return_value=response
+        ) as get, mock.patch.object(app.time, "sleep") as sleep:
+            app.fetch_repo_events("owner/repo", "https://example.com/events")
+        self.assertEqual(get.call_count, 2)
+        self.assertEqual(sleep.call_count, 1)
+        self.assertEqual(app.ERROR_STREAKS["owner/repo"], 1)
+
+    def test_poll_propagates_unexpected_worker_errors(self):
+        """Test that an unexpected exception in a worker is raised by the poll."""
+        original_repositories = app.REPOSITORIES
+        try:
+            app.REPOSITORIES = [("owner/repo", "https://example.com/events")]
+            with mock.patch.object(
+                app.SESSION, "get", return_value=self.make_response(200, {"a": 1})
+            ):
+                with self.assertRaises(AttributeError):
+                    app.poll_github_events()
+        finally:
+            app.REPOSITORIES = original_repositories
+
+    def test_failing_repo_skips_polls(self):
+        """Test that a repository that keeps failing sits out 2**streak polls."""
+        original_repositories = app.REPOSITORIES
+        try:
+            app.REPOSITORIES = [("owner/repo", "https://example.com/events")]
+            with mock.patch.object(
+                app.SESSION, "get", return_value=self.make_response(404)
+            ) as get:
+                app.poll_github_events()
+                self.assertEqual(app.SKIPPED_POLLS["owner/repo"], 2)
+                app.poll_github_events()
+                app.poll_github_events()
+                self.assertEqual(get.call_count, 1)
+                app.poll_github_events()
+                self.assertEqual(get.call_count, 2)
+                self.assertEqual(app.SKIPPED_POLLS["owner/repo"], 4)
+        finally:
+            app.REPOSITORIES = original_repositories
+
 
 class TestAPIIntegration(unittest.TestCase):
     """Integration tests for the Flask API endpoint in the application module."""
@@ -121,6 +361,7 @@ class TestAPIIntegration(unittest.TestCase):
 
     def tearDown(self):
         """Restore the original DB_FILE value and remove the temporary database file."""
+        app.close_db()
         app.DB_FILE = self.original_db_file
         os.unlink(self.temp_db.name)
 
@@ -135,6 +376,46 @@ class TestAPIIntegration(unittest.TestCase):
         self.assertIsInstance(avg_interval, float)
         self.assertGreater(avg_interval, 0)
 
+    def test_stats_endpoint_uses_latest_max_events(self):
+        """Test that /stats only averages over the latest MAX_EVENTS events."""
+        old_event = {
+            "id": "old",
+            "type": "PushEvent",
+            "created_at": (
+                datetime.datetime.now(datetime.timezone.utc)
+                - datetime.timedelta(days=1)
+            )
+            .isoformat()
+            .replace("+00:00", "Z"),
+        }
+        app.insert_event(old_event, "owner/repo")
+        original_max_events = app.MAX_EVENTS
+        try:
+            app.MAX_EVENTS = 5
+            response = self.client.get("/stats")
+        finally:
+            app.MAX_EVENTS = original_max_events
+        data = json.loads(response.data.decode("utf-8"))
+        self.assertAlmostEqual(data["owner/repo"]["PushEvent"], 300.0, delta=0.01)
+
+    def test_stats_cache_is_cleared_by_new_events(self):
+        """Test that /stats is served from cache until new events are inserted."""
+        first = json.loads(self.client.get("/stats").data.decode("utf-8"))
+        event = {
+            "id": "new",
+            "type": "WatchEvent",
+            "created_at": datetime.datetime.now(datetime.timezone.utc)
+            .isoformat()
+            .replace("+00:00", "Z"),
+        }
+        with mock.patch.object(app, "STATS_SQL", "SELECT 1 WHERE 0"):
+            cached = json.loads(self.client.get("/stats").data.decode("utf-8"))
+        self.assertEqual(cached, first)
+        app.insert_event(event, "owner/repo")
+        app.insert_event(dict(event, id="newer"), "owner/repo")
+        data = json.loads(self.client.get("/stats").data.decode("utf-8"))
+        self.assertIn("WatchEvent", data["owner/repo"])
+
 
 if __name__ == "__main__":
     unittest.main()